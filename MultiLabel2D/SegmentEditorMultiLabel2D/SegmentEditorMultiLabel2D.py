@@ -4,20 +4,25 @@ import vtk
 try:
     import zarr
 except ModuleNotFoundError:
-    slicer.util.pip_install('zarr')
+    # storage classes used for archives and bundles are not available in zarr 3
+    slicer.util.pip_install('zarr<3')
 
 import logging
 import qt
+import sqlite3
 import threading
 
 from typing import List, Dict, Optional
 from slicer.util import VTKObservationMixin
 from slicer.ScriptedLoadableModule import *
-from utils import node_utils, VolumeNotSelected, LabelManager, run_with_interval_forever
-from zarr_io import SlicerSegmentZarrWriter, SlicerSegmentZarrReader
+from utils import node_utils, VolumeNotSelected, LabelManager, run_with_interval_forever, profiler
+from utils import Worklist, WorklistCase, find_cases_in_directory, find_cases_in_dicom_database
+from zarr_io import SlicerSegmentZarrWriter, SlicerSegmentZarrReader, SegmentationBundle
 from MRMLCorePython import vtkMRMLSegmentationNode, vtkMRMLScalarVolumeNode, vtkMRMLScene
 from pathlib import Path
 
+PREVIEW_LEVELS = 3
+
 
 #
 # SegmentEditorMultiLabel2D
@@ -65,6 +70,13 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
         self._label_manager = LabelManager()
         self._periodic_label_downloader: threading.Timer = None
 
+        self._profiling_record_counter = -1
+
+        self._worklist: Optional[Worklist] = None
+        self._worklist_timer = qt.QTimer()
+        self._worklist_timer.setInterval(200)
+        self._worklist_timer.connect('timeout()', self.on_worklist_timer)
+
     def setup(self):
         """
         Called when the user opens the module the first time and the widget is initialized.
@@ -103,6 +115,7 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
         # fetch labels with 3 minutes interval
         qt.QTimer.singleShot(1, lambda: self.fetch_labels(show_warning=True))
         run_with_interval_forever(self.fetch_labels, 3 * 60)
+        run_with_interval_forever(self.update_profiling_panel, 1)
 
     def setup_self_ui(self):
         # Buttons
@@ -110,6 +123,8 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
         self._self_ui.saveAllSegmentsButton.connect('clicked(bool)', self.on_save_all_segments_button)
         self._self_ui.loadSegmentsButton.connect('clicked(bool)', self.on_load_segments_button)
         self._self_ui.loadAllSegmentsButton.connect('clicked(bool)', self.on_load_all_segments_button)
+        self._self_ui.saveBundleButton.connect('clicked(bool)', self.on_save_bundle_button)
+        self._self_ui.loadBundleButton.connect('clicked(bool)', self.on_load_bundle_button)
         self._self_ui.fillSegmentsButton.connect('clicked(bool)', self.on_fill_segments_button)
         self._self_ui.syncLabelListButton.connect('clicked(bool)', self.on_sync_labels_button)
 
@@ -117,9 +132,19 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
         self._self_ui.nextVolumeButton.connect('clicked(bool)', lambda: self.on_change_volume('next'))
         self._self_ui.closeVolumeButton.connect('clicked(bool)', self.on_close_current_volume)
 
+        self._self_ui.openWorklistButton.connect('clicked(bool)', self.on_open_worklist_button)
+        self._self_ui.dicomWorklistButton.connect('clicked(bool)', self.on_dicom_worklist_button)
+        self._self_ui.closeWorklistButton.connect('clicked(bool)', self.on_close_worklist_button)
+
         self._self_ui.volumeSelector.setMRMLScene(self._scene)
         self._self_ui.volumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.on_volume_node_changed)
 
+        # Profiling
+        self._self_ui.profilingEnabledCheckBox.setChecked(profiler.enabled)
+        self._self_ui.profilingEnabledCheckBox.connect('toggled(bool)', self.on_profiling_enabled_toggled)
+        self._self_ui.profilingResetButton.connect('clicked(bool)', self.on_profiling_reset_button)
+        self._self_ui.profilingExportButton.connect('clicked(bool)', self.on_profiling_export_button)
+
     def setup_ui_defaults(self):
         default_segment_editor_node = slicer.vtkMRMLSegmentEditorNode()
         default_segment_editor_node.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteNone)
@@ -147,6 +172,36 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
             else:
                 logging.warning(msg)
 
+    def on_profiling_enabled_toggled(self, enabled: bool):
+        profiler.enabled = enabled
+
+    def on_profiling_reset_button(self):
+        profiler.reset()
+        self.update_profiling_panel()
+
+    def on_profiling_export_button(self):
+        file_path = qt.QFileDialog().getSaveFileName(None, 'Export profiling data', 'profiling.json', '*.json')
+        if file_path == '':
+            return
+
+        profiler.export_json(Path(file_path))
+        profiler.log_summary()
+
+    def update_profiling_panel(self, history_size=20):
+        if profiler.record_counter == self._profiling_record_counter:
+            return
+        self._profiling_record_counter = profiler.record_counter
+
+        lines = [f'{r.name}: {r.duration * 1000:.1f} ms' for r in reversed(profiler.recent()[-history_size:])]
+        lines.append('')
+        for name, s in profiler.stats().items():
+            lines.append(f'{name}: n={s.count} total={s.total:.2f}s p50={s.p50 * 1000:.1f}ms p95={s.p95 * 1000:.1f}ms')
+
+        self._self_ui.profilingTextEdit.setPlainText('\n'.join(lines))
+
+    def get_preview_levels(self) -> int:
+        return PREVIEW_LEVELS if self._self_ui.savePreviewsCheckBox.checked else 0
+
     def on_save_segments_button(self):
         try:
             volume_node = self.get_current_volume()
@@ -173,7 +228,8 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
             slicer.util.errorDisplay(f'There is no segmentation node for current volume node.')
             return
 
-        with SlicerSegmentZarrWriter(mask_file_path) as writer:
+        writer = SlicerSegmentZarrWriter(mask_file_path, self.get_preview_levels())
+        with profiler.span('save_segments'), writer:
             writer.write_segmentation_node(seg_node)
 
     def on_save_all_segments_button(self):
@@ -209,7 +265,8 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
                         display_override_all = False
                 else:
                     continue
-            with SlicerSegmentZarrWriter(mask_file_path) as writer:
+            writer = SlicerSegmentZarrWriter(mask_file_path, self.get_preview_levels())
+            with profiler.span('save_segments'), writer:
                 out_seg_file_names.append(mask_file_path.name)
                 writer.write_segmentation_node(seg_node)
         seg_names_str = '\n'.join(out_seg_file_names)
@@ -258,6 +315,62 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
         except VolumeNotSelected:
             pass
 
+    def on_save_bundle_button(self):
+        # noinspection PyTypeChecker
+        seg_nodes: Dict[str, vtkMRMLSegmentationNode] = node_utils.get_nodes_by_class('vtkMRMLSegmentationNode')
+
+        if len(seg_nodes) == 0:
+            slicer.util.infoDisplay('There are no segmentations to save.')
+            return
+
+        member_masks: Dict[str, List[str]] = {}
+        for mask_name in seg_nodes:
+            member_masks.setdefault(Path(mask_name).stem, []).append(mask_name)
+        duplicates = [masks for masks in member_masks.values() if len(masks) > 1]
+        if len(duplicates) > 0:
+            duplicates_str = '\n'.join(', '.join(masks) for masks in duplicates)
+            slicer.util.warningDisplay(f'Following segmentations would be saved under the same name, '
+                                       f'please rename them before saving:\n{duplicates_str}')
+            return
+
+        file_path = qt.QFileDialog().getSaveFileName(None, 'Save to bundle', '', '*.segbundle')
+        if file_path == '':
+            return
+
+        try:
+            with profiler.span('save_bundle'), SegmentationBundle(Path(file_path)) as bundle:
+                for mask_name, seg_node in seg_nodes.items():
+                    writer = bundle.writer(Path(mask_name).stem, SlicerSegmentZarrWriter,
+                                           preview_levels=self.get_preview_levels())
+                    with writer as w:
+                        w.write_segmentation_node(seg_node)
+        except sqlite3.DatabaseError as e:
+            slicer.util.errorDisplay(f'Unable to save to {Path(file_path).name}, it is not a valid bundle: {e}')
+            return
+
+        slicer.util.infoDisplay(f'Segments of {len(seg_nodes)} volumes have been saved to {Path(file_path).name}.')
+
+    def on_load_bundle_button(self):
+        file_path = qt.QFileDialog().getOpenFileName(None, 'Load bundle', '', '*.segbundle')
+        if file_path == '':
+            return
+
+        try:
+            with profiler.span('load_bundle'), SegmentationBundle(Path(file_path)) as bundle:
+                bundle_volumes = bundle.get_volume_list()
+                for name, volume_node in node_utils.get_nodes_by_class('vtkMRMLScalarVolumeNode').items():
+                    if Path(name).stem in bundle_volumes:
+                        # noinspection PyTypeChecker
+                        self.load_segments_for_volume(volume_node, Path(file_path), bundle)
+        except sqlite3.DatabaseError as e:
+            slicer.util.errorDisplay(f'Unable to load {Path(file_path).name}, it is not a valid bundle: {e}')
+            return
+
+        try:
+            self.on_volume_node_changed(self.get_current_volume())
+        except VolumeNotSelected:
+            pass
+
     def on_fill_segments_button(self):
         self.fill_segments_for_current_node()
 
@@ -295,6 +408,17 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
         if volume_node is None:
             logging.error(f'No scalar volume selected.')
             return
+
+        with profiler.span('on_volume_node_changed'):
+            self.show_volume_node(volume_node)
+
+    def show_volume_node(self, volume_node: vtkMRMLScalarVolumeNode):
+        if self._worklist is not None:
+            worklist_index = self._worklist.find_index(volume_node)
+            if worklist_index is not None:
+                self._worklist.current_index = worklist_index
+            self.update_worklist_label()
+
         # logging.info(f'Selected scalar volume: {volume_node.GetName()}.')
         self._vol_ui.ActiveVolumeNodeSelector.setCurrentNode(volume_node)
         self._self_ui.volumeSelector.setCurrentNode(volume_node)
@@ -337,7 +461,59 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
         else:
             self._scene.RemoveNode(volume_node)
 
+    def on_open_worklist_button(self):
+        worklist_dir = qt.QFileDialog().getExistingDirectory()
+        if worklist_dir == '':
+            return
+
+        self.open_worklist(find_cases_in_directory(Path(worklist_dir)))
+
+    def on_dicom_worklist_button(self):
+        self.open_worklist(find_cases_in_dicom_database())
+
+    def on_close_worklist_button(self):
+        if self._worklist is None:
+            return
+
+        self._worklist_timer.stop()
+        self._worklist.close()
+        self._worklist = None
+        self._self_ui.worklistLabel.setText('')
+
+    def on_worklist_timer(self):
+        if self._worklist is not None:
+            self._worklist.process_loaded()
+
+    def open_worklist(self, cases: List[WorklistCase]):
+        if len(cases) == 0:
+            slicer.util.infoDisplay('No volumes found for worklist.')
+            return
+
+        self.on_close_worklist_button()
+        self._worklist = Worklist(cases)
+        self._worklist_timer.start()
+        self.change_worklist_case(lambda: self._worklist.go_to(0))
+
+    def change_worklist_case(self, load_volume_node):
+        try:
+            volume_node = load_volume_node()
+        except Exception as e:
+            slicer.util.errorDisplay(f'Unable to load volume: {e}')
+            return
+
+        self.on_volume_node_changed(volume_node)
+
+    def update_worklist_label(self):
+        if self._worklist is None:
+            return
+        self._self_ui.worklistLabel.setText(f'Case {self._worklist.current_index + 1}/{len(self._worklist.cases)}: '
+                                            f'{self._worklist.current_case.name}')
+
     def on_change_volume(self, direction: str):
+        if self._worklist is not None:
+            self.change_worklist_case(lambda: self._worklist.move(direction))
+            return
+
         nodes = slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode')
 
         if len(nodes) == 0:
@@ -367,7 +543,8 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
     def load_segments_for_volume(
             self,
             volume_node: vtkMRMLScalarVolumeNode,
-            file_path: Path
+            file_path: Path,
+            bundle: SegmentationBundle = None
     ):
         # noinspection PyTypeChecker
         seg_node: vtkMRMLSegmentationNode = node_utils.get_nodes_by_class('vtkMRMLSegmentationNode',
@@ -387,8 +564,14 @@ class SegmentEditorMultiLabel2DWidget(ScriptedLoadableModuleWidget, VTKObservati
         if labels is None:
             return
 
-        with SlicerSegmentZarrReader(file_path) as reader:
-            reader.read_to_segmentation_node(seg_node, labels)
+        if bundle is not None:
+            reader = bundle.reader(Path(volume_node.GetName()).stem, SlicerSegmentZarrReader)
+        else:
+            reader = SlicerSegmentZarrReader(file_path)
+
+        with profiler.span('load_segments'), reader:
+            reader.read_to_segmentation_node(seg_node, labels,
+                                             shared_layers=self._self_ui.sharedLayersCheckBox.checked)
 
         self._se_ui.SegmentationNodeComboBox.setCurrentNode(seg_node)
 
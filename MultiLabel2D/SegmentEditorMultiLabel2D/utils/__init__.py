@@ -1,2 +1,8 @@
-from .misc import *
-from .label_manager import *
+from .app import *
+from .profiling import *
+
+# command line tools run outside of Slicer application, where only Slicer independent modules can be imported
+if running_in_slicer():
+    from .misc import *
+    from .label_manager import *
+    from .worklist import *
@@ -0,0 +1,9 @@
+import sys
+
+
+def running_in_slicer() -> bool:
+    """
+    True inside Slicer application, which imports ``slicer`` and sets ``slicer.app`` before modules are loaded.
+    PythonSlicer also has ``slicer`` on its path, but runs without the application and PythonQt.
+    """
+    return hasattr(sys.modules.get('slicer'), 'app')
@@ -5,9 +5,9 @@ from typing import List, Dict, Union, Tuple
 import numpy as np
 import slicer
 from MRMLCorePython import vtkMRMLScalarVolumeNode, vtkMRMLSegmentationNode, vtkMRMLNode
-from vtkSegmentationCorePython import vtkSegmentation
+from vtkSegmentationCorePython import vtkSegmentation, vtkOrientedImageData
 
-from utils import generate_colors
+from utils import generate_colors, profiler
 
 
 def create_segment_node_for_volume(
@@ -39,6 +39,7 @@ def create_empty_segments(
         segment.SetColor(color)
 
 
+@profiler.profiled('create_new_segment')
 def create_new_segment(
         name: str,
         seg_node: vtkMRMLSegmentationNode,
@@ -52,6 +53,44 @@ def create_new_segment(
     return segment_id
 
 
+def create_labelmap_layer(
+        seg_node: vtkMRMLSegmentationNode,
+        layer_value: np.ndarray
+) -> vtkOrientedImageData:
+    reference_volume_node = seg_node.GetNodeReference(
+        slicer.vtkMRMLSegmentationNode.GetReferenceImageGeometryReferenceRole())
+    labelmap_node = slicer.modules.volumes.logic().CreateAndAddLabelVolume(reference_volume_node, '__temp__')
+    try:
+        slicer.util.updateVolumeFromArray(labelmap_node, layer_value)
+        return slicer.vtkSlicerSegmentationsModuleLogic.CreateOrientedImageDataFromVolumeNode(labelmap_node)
+    finally:
+        slicer.mrmlScene.RemoveNode(labelmap_node)
+
+
+@profiler.profiled('create_shared_labelmap_segment')
+def create_shared_labelmap_segment(
+        name: str,
+        seg_node: vtkMRMLSegmentationNode,
+        layer_image: vtkOrientedImageData,
+        label_value: int,
+        color: Tuple[float, ...] = None
+) -> str:
+    """
+    Adds segment represented by voxels of ``layer_image`` equal to ``label_value``. Segments referencing
+    the same image data object are stored by Slicer in one shared labelmap layer.
+    """
+    segment = slicer.vtkSegment()
+    segment.SetName(name)
+    if color is not None:
+        segment.SetColor(color)
+    segment.SetLabelValue(label_value)
+    segment.AddRepresentation(slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName(), layer_image)
+
+    segmentation: vtkSegmentation = seg_node.GetSegmentation()
+    segmentation.AddSegment(segment)
+    return segmentation.GetSegmentIdBySegment(segment)
+
+
 def get_path_of_node(node) -> Path:
     storage_node = node.GetStorageNode()
     if storage_node is not None:  # loaded via drag-drop
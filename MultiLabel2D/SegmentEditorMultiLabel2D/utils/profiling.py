@@ -0,0 +1,140 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Dict, List, Deque, Callable, Any, NamedTuple
+
+import numpy as np
+
+
+class SpanRecord(NamedTuple):
+    name: str
+    start: float
+    duration: float
+
+
+class SpanStats(NamedTuple):
+    count: int
+    total: float
+    p50: float
+    p95: float
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, profiler: 'Profiler', name: str):
+        self._profiler = profiler
+        self._name = name
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._profiler.record(self._name, self._start, time.perf_counter() - self._start)
+        return False
+
+
+class Profiler:
+    """
+    Collects wall-clock durations of named spans. When disabled ``span`` returns a shared no-op
+    context manager, so instrumented code pays only for one attribute lookup.
+    """
+
+    def __init__(self, enabled: bool = False, history_size: int = 100, samples_per_span: int = 10000):
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._totals: Dict[str, float] = defaultdict(float)
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=samples_per_span))
+        self._history: Deque[SpanRecord] = deque(maxlen=history_size)
+        self._record_counter = 0
+
+    def span(self, name: str):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def profiled(self, name: str = None) -> Callable:
+        def decorator(fn: Callable) -> Callable:
+            span_name = name or fn.__qualname__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs) -> Any:
+                with self.span(span_name):
+                    return fn(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, name: str, start: float, duration: float):
+        with self._lock:
+            self._counts[name] += 1
+            self._totals[name] += duration
+            self._samples[name].append(duration)
+            self._history.append(SpanRecord(name, start, duration))
+            self._record_counter += 1
+
+    @property
+    def record_counter(self) -> int:
+        return self._record_counter
+
+    def stats(self) -> Dict[str, SpanStats]:
+        with self._lock:
+            samples = {n: np.array(s, dtype=np.float64) for n, s in self._samples.items()}
+            counts = dict(self._counts)
+            totals = dict(self._totals)
+
+        return {
+            n: SpanStats(counts[n], totals[n], float(np.percentile(s, 50)), float(np.percentile(s, 95)))
+            for n, s in sorted(samples.items())
+        }
+
+    def recent(self) -> List[SpanRecord]:
+        with self._lock:
+            return list(self._history)
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+            self._totals.clear()
+            self._samples.clear()
+            self._history.clear()
+            self._record_counter = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'stats': {n: s._asdict() for n, s in self.stats().items()},
+            'recent': [r._asdict() for r in self.recent()]
+        }
+
+    def export_json(self, file_path: Path):
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def log_summary(self, level: int = logging.INFO):
+        for n, s in self.stats().items():
+            logging.log(level, f'{n}: count={s.count} total={s.total:.3f}s p50={s.p50 * 1000:.1f}ms '
+                               f'p95={s.p95 * 1000:.1f}ms')
+
+
+profiler = Profiler(enabled=os.environ.get('MULTILABEL2D_PROFILE', '') not in ('', '0'))
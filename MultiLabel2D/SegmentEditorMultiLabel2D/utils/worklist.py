@@ -0,0 +1,227 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import List, Dict, NamedTuple, Tuple, Optional, Set, OrderedDict as OrderedDictType
+
+import numpy as np
+import SimpleITK as sitk
+import sitkUtils
+import slicer
+from MRMLCorePython import vtkMRMLScalarVolumeNode
+
+from utils.profiling import profiler
+
+VOLUME_FILE_SUFFIXES = ('.nii.gz', '.nii', '.nrrd', '.nhdr', '.mha', '.mhd')
+
+
+class WorklistCase(NamedTuple):
+    name: str
+    file_paths: Tuple[Path, ...]
+    # set for series of Slicer DICOM database, whose files are not sorted by slice position
+    series_uid: str = ''
+
+
+def get_case_name(series_uid: str) -> str:
+    # volume names are turned into file names with Path(name).stem, which would cut the last UID component
+    return series_uid.replace('.', '_')
+
+
+def sort_series_files(file_paths: Tuple[Path, ...]) -> Tuple[Path, ...]:
+    """
+    Sorts DICOM files of a series along slice normal, as done by GDCM for series found in directories.
+    Files are returned in given order when their position or orientation is missing.
+    """
+    reader = sitk.ImageFileReader()
+    positions = []
+    for file_path in file_paths:
+        reader.SetFileName(file_path.as_posix())
+        reader.ReadImageInformation()
+        if not reader.HasMetaDataKey('0020|0032') or not reader.HasMetaDataKey('0020|0037'):
+            return file_paths
+        orientation = [float(v) for v in reader.GetMetaData('0020|0037').split('\\')]
+        position = [float(v) for v in reader.GetMetaData('0020|0032').split('\\')]
+        positions.append(np.dot(np.cross(orientation[:3], orientation[3:]), position))
+
+    return tuple(file_paths[i] for i in np.argsort(positions, kind='stable'))
+
+
+def read_case_image(case: WorklistCase) -> sitk.Image:
+    with profiler.span('worklist.read_image'):
+        if len(case.file_paths) == 1:
+            return sitk.ReadImage(case.file_paths[0].as_posix())
+
+        file_paths = sort_series_files(case.file_paths) if case.series_uid else case.file_paths
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames([p.as_posix() for p in file_paths])
+        return reader.Execute()
+
+
+def find_cases_in_directory(root_dir: Path) -> List[WorklistCase]:
+    """
+    Registers volume files and DICOM series found under ``root_dir`` without reading pixel data.
+    """
+    cases = []
+    # root directory itself may hold a DICOM series
+    for file_path in [root_dir, *sorted(root_dir.rglob('*'))]:
+        suffix = next((s for s in VOLUME_FILE_SUFFIXES if file_path.name.endswith(s)), None)
+        if suffix is not None and file_path.is_file():
+            cases.append(WorklistCase(file_path.name[:-len(suffix)], (file_path,)))
+        elif file_path.is_dir():
+            for series_id in sitk.ImageSeriesReader.GetGDCMSeriesIDs(file_path.as_posix()):
+                series_files = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(file_path.as_posix(), series_id)
+                cases.append(WorklistCase(get_case_name(series_id), tuple(Path(f) for f in series_files)))
+    return cases
+
+
+def find_cases_in_dicom_database() -> List[WorklistCase]:
+    """
+    Registers all series of Slicer DICOM database without reading pixel data. Files are sorted by slice position
+    when the series is read.
+    """
+    db = slicer.dicomDatabase
+    cases = []
+    for patient in db.patients():
+        for study in db.studiesForPatient(patient):
+            for series in db.seriesForStudy(study):
+                file_paths = tuple(Path(f) for f in db.filesForSeries(series))
+                if len(file_paths) > 0:
+                    cases.append(WorklistCase(get_case_name(series), file_paths, series))
+    return cases
+
+
+class Worklist:
+    """
+    Ordered list of cases of which only the current one and ``prefetch`` neighbours on each side are kept
+    loaded. Images are read in background threads, while volume nodes are created on the main thread
+    by ``process_loaded``, which should be called periodically. Least recently used volumes are removed
+    from the scene when more than ``cache_size`` are loaded.
+    """
+
+    def __init__(self, cases: List[WorklistCase], prefetch: int = 1, cache_size: int = 5, workers: int = 2):
+        if len(cases) == 0:
+            raise ValueError('Worklist is empty.')
+
+        self.cases = cases
+        self.current_index = 0
+
+        self._prefetch = prefetch
+        self._cache_size = max(cache_size, 2 * prefetch + 1)
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending: Dict[int, Future] = {}
+        self._loaded: OrderedDictType[int, vtkMRMLScalarVolumeNode] = OrderedDict()
+
+    @property
+    def current_case(self) -> WorklistCase:
+        return self.cases[self.current_index]
+
+    def move(self, direction: str) -> vtkMRMLScalarVolumeNode:
+        if direction == 'prev':
+            step = -1
+        elif direction == 'next':
+            step = 1
+        else:
+            raise ValueError()
+
+        return self.go_to((self.current_index + step) % len(self.cases))
+
+    def go_to(self, index: int) -> vtkMRMLScalarVolumeNode:
+        # current case changes only when its volume is loaded successfully
+        volume_node = self.get_volume_node(index)
+        self.current_index = index
+
+        for offset in range(1, self._prefetch + 1):
+            for i in [(index + offset) % len(self.cases), (index - offset) % len(self.cases)]:
+                self._schedule(i)
+
+        self._evict()
+        return volume_node
+
+    def get_volume_node(self, index: int) -> vtkMRMLScalarVolumeNode:
+        """
+        Returns volume node of the case, waiting for its image when it is not loaded yet.
+        """
+        self._drop_removed()
+        if index in self._loaded:
+            self._loaded.move_to_end(index)
+            return self._loaded[index]
+
+        self._schedule(index)
+        with profiler.span('worklist.wait_image'):
+            image = self._pending.pop(index).result()
+
+        return self._add_volume_node(index, image)
+
+    def find_index(self, volume_node: vtkMRMLScalarVolumeNode) -> Optional[int]:
+        for index, node in self._loaded.items():
+            if node is volume_node:
+                return index
+        return None
+
+    def process_loaded(self):
+        window = self._window()
+        for index, future in list(self._pending.items()):
+            if not future.done():
+                continue
+            del self._pending[index]
+
+            if index not in window:  # user has moved on before the image was read
+                continue
+            try:
+                self._add_volume_node(index, future.result())
+            except Exception as e:
+                logging.error(f'Unable to load case {self.cases[index].name}: {e}')
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._pending.clear()
+        for volume_node in self._loaded.values():
+            slicer.mrmlScene.RemoveNode(volume_node)
+        self._loaded.clear()
+
+    def _schedule(self, index: int):
+        if index not in self._loaded and index not in self._pending:
+            self._pending[index] = self._executor.submit(read_case_image, self.cases[index])
+
+    def _add_volume_node(self, index: int, image: sitk.Image) -> vtkMRMLScalarVolumeNode:
+        case = self.cases[index]
+
+        with profiler.span('worklist.push_volume'):
+            volume_node: vtkMRMLScalarVolumeNode = sitkUtils.PushVolumeToSlicer(image, name=case.name)
+
+        if case.series_uid:
+            instance_uids = slicer.dicomDatabase.instancesForSeries(case.series_uid)
+            volume_node.SetAttribute('DICOM.instanceUIDs', ' '.join(instance_uids))
+        elif len(case.file_paths) == 1:
+            volume_node.AddDefaultStorageNode()
+            volume_node.GetStorageNode().SetFileName(case.file_paths[0].as_posix())
+
+        self._loaded[index] = volume_node
+        return volume_node
+
+    def _drop_removed(self):
+        # volumes closed by the user or removed with the scene are read again when needed
+        for index, volume_node in list(self._loaded.items()):
+            if not slicer.mrmlScene.IsNodePresent(volume_node):
+                del self._loaded[index]
+
+    def _window(self) -> Set[int]:
+        return {(self.current_index + offset) % len(self.cases)
+                for offset in range(-self._prefetch, self._prefetch + 1)}
+
+    def _evict(self):
+        window = self._window()
+
+        for index in list(self._loaded):
+            if len(self._loaded) <= self._cache_size:
+                break
+            if index in window:
+                continue
+            # segmentation nodes are kept, so annotations of evicted cases stay in the scene
+            slicer.mrmlScene.RemoveNode(self._loaded.pop(index))
+
+        for index in [i for i in self._pending if i not in window]:
+            if self._pending[index].cancel():
+                del self._pending[index]
+
@@ -1,3 +1,9 @@
-from .slicer_segment_zarr_io import *
+from utils import running_in_slicer
+
 from .bin_array_zarr_io import *
 from .segmentation_zarr_io import *
+from .bundle_zarr_io import *
+
+# command line tools run outside of Slicer application, where only Slicer independent modules can be imported
+if running_in_slicer():
+    from .slicer_segment_zarr_io import *
@@ -0,0 +1,170 @@
+"""
+QA statistics of .seg archives computed directly on packed bits, without unpacking masks.
+
+Usage (from the SegmentEditorMultiLabel2D directory, e.g. with PythonSlicer):
+
+    python -m zarr_io.analytics /path/to/archives --output-prefix qa --workers 8
+
+Writes ``qa_segments.csv`` with area of every segment and ``qa_overlaps.csv`` with every pair of overlapping
+segments.
+"""
+import argparse
+import csv
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+import zarr
+
+from .bin_array_zarr_io import PACKED_CHUNK_SIZE, chunk_aligned_block_size
+from .segmentation_zarr_io import SegmentationZarrReader
+
+# number of set bits of every possible byte value
+_POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1, dtype=np.uint8)
+
+# packed bytes of each array processed at once by pairwise AND and popcount, which allocate two temporaries
+# of arrays count times this size
+PAIRWISE_BLOCK_SIZE = 1 << 14
+
+
+class SegmentationStats(NamedTuple):
+    file_path: Path
+    names: List[str]
+    shape: Tuple[int, ...]
+    # overlaps[i, j] is the number of voxels set in both segments i and j, diagonal holds segment areas
+    overlaps: np.ndarray
+
+    @property
+    def areas(self) -> np.ndarray:
+        return np.diagonal(self.overlaps)
+
+    @property
+    def unions(self) -> np.ndarray:
+        return self.areas[:, np.newaxis] + self.areas[np.newaxis, :] - self.overlaps
+
+    @property
+    def dice(self) -> np.ndarray:
+        sums = self.areas[:, np.newaxis] + self.areas[np.newaxis, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(sums > 0, 2 * self.overlaps / sums, 0.0)
+
+    def get_empty_segments(self) -> List[str]:
+        return [n for n, a in zip(self.names, self.areas) if a == 0]
+
+    def get_overlapping_pairs(self) -> List[Tuple[str, str, int, float]]:
+        dice = self.dice
+        rows, cols = np.nonzero(np.triu(self.overlaps, k=1))
+        return [(self.names[i], self.names[j], int(self.overlaps[i, j]), float(dice[i, j]))
+                for i, j in zip(rows, cols)]
+
+
+def popcount(packed: np.ndarray, axis: int = -1) -> np.ndarray:
+    return _POPCOUNT_TABLE[packed].sum(axis=axis, dtype=np.int64)
+
+
+def compute_packed_overlaps(arrays: List[zarr.Array], block_size: int = None) -> np.ndarray:
+    """
+    Pairwise counts of voxels set in both of packed binary arrays, computed with bitwise AND of packed bytes,
+    block by block. Empty arrays (of zero length) contribute no voxels. Blocks are aligned to chunks, so each
+    chunk is decompressed once. Memory use is the number of arrays times the block size for decompressed blocks,
+    plus twice the number of arrays times PAIRWISE_BLOCK_SIZE for temporaries of the pairwise step.
+    """
+    count = len(arrays)
+    overlaps = np.zeros((count, count), dtype=np.int64)
+
+    non_empty = [i for i, arr in enumerate(arrays) if arr.shape[0] > 0]
+    if len(non_empty) == 0:
+        return overlaps
+
+    packed_size = arrays[non_empty[0]].shape[0]
+    if any(arrays[i].shape[0] != packed_size for i in non_empty):
+        raise ValueError('Packed arrays differ in size.')
+    block_size = chunk_aligned_block_size(arrays[non_empty[0]], block_size or PACKED_CHUNK_SIZE)
+
+    sub_overlaps = np.zeros((len(non_empty), len(non_empty)), dtype=np.int64)
+    block_buffer = np.empty((len(non_empty), min(block_size, packed_size)), dtype=np.uint8)
+    for start in range(0, packed_size, block_size):
+        stop = min(start + block_size, packed_size)
+        blocks = block_buffer[:, :stop - start]
+        for k, i in enumerate(non_empty):
+            arrays[i].get_basic_selection(slice(start, stop), out=blocks[k])
+        for sub_start in range(0, blocks.shape[1], PAIRWISE_BLOCK_SIZE):
+            sub_blocks = blocks[:, sub_start:sub_start + PAIRWISE_BLOCK_SIZE]
+            for k in range(len(non_empty)):
+                sub_overlaps[k, k:] += popcount(sub_blocks[k] & sub_blocks[k:])
+
+    sub_overlaps = np.triu(sub_overlaps) + np.triu(sub_overlaps, k=1).T
+    overlaps[np.ix_(non_empty, non_empty)] = sub_overlaps
+    return overlaps
+
+
+def analyze_archive(file_path: Path, block_size: int = None) -> SegmentationStats:
+    with SegmentationZarrReader(file_path) as reader:
+        names = sorted(reader.get_segmentation_list())
+        arrays = [reader.get_packed_array(n, reader.root['segmentations']) for n in names]
+        shape = tuple(arrays[0].attrs['packed_shape']) if len(arrays) > 0 else ()
+
+        return SegmentationStats(file_path, names, shape, compute_packed_overlaps(arrays, block_size))
+
+
+def _analyze_worker(file_path: Path) -> Tuple[Path, SegmentationStats, str]:
+    try:
+        return file_path, analyze_archive(file_path), ''
+    except Exception as e:
+        return file_path, None, repr(e)
+
+
+def analyze_directory(root_dir: Path, workers: int = None) -> List[SegmentationStats]:
+    archives = sorted(root_dir.rglob('*.seg'))
+    logging.info(f'Found {len(archives)} archives under {root_dir}.')
+
+    stats = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for file_path, file_stats, error in executor.map(_analyze_worker, archives, chunksize=16):
+            if file_stats is None:
+                logging.error(f'{file_path}: {error}')
+            else:
+                stats.append(file_stats)
+    return stats
+
+
+def write_reports(stats: List[SegmentationStats], output_prefix: Path):
+    with open(f'{output_prefix}_segments.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'segment', 'area', 'empty', 'overlapping_segments'])
+        for file_stats in stats:
+            overlapping = (file_stats.overlaps > 0).sum(axis=1) - (file_stats.areas > 0)
+            for name, area, n in zip(file_stats.names, file_stats.areas, overlapping):
+                writer.writerow([file_stats.file_path.as_posix(), name, int(area), area == 0, int(n)])
+
+    with open(f'{output_prefix}_overlaps.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'segment_a', 'segment_b', 'overlap', 'dice'])
+        for file_stats in stats:
+            for pair in file_stats.get_overlapping_pairs():
+                writer.writerow([file_stats.file_path.as_posix(), *pair])
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Compute overlap and area statistics of .seg archives.')
+    parser.add_argument('root_dir', type=Path, help='Directory searched recursively for .seg archives.')
+    parser.add_argument('--output-prefix', type=Path, required=True, help='Prefix of written CSV reports.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, defaults to CPU count.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    stats = analyze_directory(args.root_dir, args.workers)
+    write_reports(stats, args.output_prefix)
+
+    logging.info(f'{len(stats)} archives analyzed, '
+                 f'{sum(len(s.get_empty_segments()) for s in stats)} empty segments, '
+                 f'{sum(len(s.get_overlapping_pairs()) for s in stats)} overlapping segment pairs.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
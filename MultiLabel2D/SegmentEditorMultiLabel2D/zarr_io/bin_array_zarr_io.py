@@ -1,64 +1,169 @@
 from pathlib import Path
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Tuple, Iterator
 
 import numpy as np
 import zarr
 from numcodecs import Blosc
+from zarr.storage import BaseStore
+
+from utils import profiler
+
+# Version of the archive layout, stored in root attrs. Archives without the attribute are version 1.
+#   1 - packed arrays with default zarr chunking
+#   2 - packed arrays chunked by PACKED_CHUNK_SIZE, array attributes written once
+FORMAT_VERSION = 2
+LEGACY_FORMAT_VERSION = 1
+
+# format versions in which every array holds np.packbits of the flattened mask
+PACKED_LAYOUT_VERSIONS = (1, 2)
+
+# packed bytes per stored chunk, also the unit of streaming decode in BinArrayZarrReader
+PACKED_CHUNK_SIZE = 1 << 20
+
+# bits of every possible byte value, used to unpack a block directly into the output buffer
+_UNPACK_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1)
+
+
+def chunk_aligned_block_size(arr: zarr.Array, target_size: int = PACKED_CHUNK_SIZE) -> int:
+    """
+    Size of packed blocks closest to ``target_size`` made of whole chunks, so every chunk is decompressed once.
+    """
+    return max(arr.chunks[0], target_size // arr.chunks[0] * arr.chunks[0])
+
+
+def _unpack_blocks(arr: zarr.Array, out: np.ndarray):
+    bit_count = out.size
+    block_size = chunk_aligned_block_size(arr)
+
+    for start in range(0, arr.shape[0], block_size):
+        block = arr[start:start + block_size]
+
+        bit_start = start * 8
+        full_bytes = min(len(block), (bit_count - bit_start) // 8)
+        bit_stop = bit_start + full_bytes * 8
+
+        np.take(_UNPACK_TABLE, block[:full_bytes], axis=0, out=out[bit_start:bit_stop].reshape(-1, 8))
+        if bit_stop < bit_count and full_bytes < len(block):
+            out[bit_stop:] = _UNPACK_TABLE[block[full_bytes], :bit_count - bit_stop]
+
+
+_PACKED_DECODERS = {
+    1: _unpack_blocks,
+    2: _unpack_blocks
+}
 
 
 class BinArrayZarrReader:
 
-    def __init__(self, dest_path: Path):
+    def __init__(self, dest_path: Path, store: BaseStore = None, path: str = None):
+        """
+        Reads zip archive ``dest_path`` or, when ``store`` is given, group ``path`` of that store,
+        which is left open on exit.
+        """
         self._dest_path = dest_path
+        self._path = path
 
-        self._store = zarr.ZipStore(dest_path.as_posix(), mode='r')
+        self._owns_store = store is None
+        if store is None:
+            # central directory of the zip is read here
+            with profiler.span('zip.open'):
+                store = zarr.ZipStore(dest_path.as_posix(), mode='r')
+        self._store = store
 
         self.root: zarr.Group = None
+        self.format_version: int = None
 
     def __enter__(self):
-        self.root = zarr.open(self._store)
+        with profiler.span('zarr.open_group'):
+            self.root = zarr.open(self._store, path=self._path)
+
+        self.format_version = self.root.attrs.get('format_version', LEGACY_FORMAT_VERSION)
+        if self.format_version not in _PACKED_DECODERS:
+            self.__exit__()
+            raise ValueError(f'Unsupported format version {self.format_version} of {self._dest_path}.')
+
         return self
 
     def __exit__(self, *args):
-        self._store.close()
+        if self._owns_store:
+            with profiler.span('zip.close'):
+                self._store.close()
         self.root = None
 
-    @staticmethod
     def read_bin_array(
+            self,
             name: str,
-            group: zarr.Group
+            group: zarr.Group,
+            out: np.ndarray = None
     ) -> Tuple[np.ndarray, Dict]:
+        """
+        Decodes binary array block by block into ``out`` (allocated when not given), so peak memory is
+        the output size plus a single packed block.
+        """
         arr: zarr.Array = group[name]
-        arr_shape = arr.attrs['packed_shape']
+        arr_shape = tuple(arr.attrs['packed_shape'])
 
-        if arr.attrs['empty']:
-            bin_array = np.zeros(arr_shape, dtype=np.uint8)
-        else:
-            bin_array = np.unpackbits(arr[:], count=int(np.prod(arr_shape))).reshape(arr_shape)
+        if out is None:
+            out = np.empty(arr_shape, dtype=np.uint8)
+        elif out.shape != arr_shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+            raise ValueError(f'Output buffer must be a contiguous uint8 array of shape {arr_shape}.')
+
+        with profiler.span('read_bin_array'):
+            if arr.attrs['empty']:
+                out.fill(0)
+            else:
+                _PACKED_DECODERS[self.format_version](arr, out.reshape(-1))
 
         attrs = arr.attrs.asdict()
         attrs.pop('empty')
         attrs.pop('packed_shape')
 
-        return bin_array, attrs
+        return out, attrs
+
+    def get_packed_array(
+            self,
+            name: str,
+            group: zarr.Group
+    ) -> zarr.Array:
+        """
+        Returns stored array for computations directly on packed bits, which are valid only for
+        PACKED_LAYOUT_VERSIONS.
+        """
+        if self.format_version not in PACKED_LAYOUT_VERSIONS:
+            raise ValueError(f'Format version {self.format_version} of {self._dest_path} does not store '
+                             f'plain packed arrays.')
+        return group[name]
 
 
 class BinArrayZarrWriter:
 
-    def __init__(self, src_path: Path):
+    def __init__(self, src_path: Path, store: BaseStore = None, path: str = None):
+        """
+        Writes zip archive ``src_path`` or, when ``store`` is given, group ``path`` of that store,
+        which is left open on exit.
+        """
         self._src_path = src_path
+        self._path = path
 
-        self._store = zarr.ZipStore(src_path.as_posix(), mode='w')
+        self._owns_store = store is None
+        if store is None:
+            with profiler.span('zip.open'):
+                store = zarr.ZipStore(src_path.as_posix(), mode='w')
+        self._store = store
         self._compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
 
         self.root: zarr.Group = None
 
     def __enter__(self):
-        self.root = zarr.open(self._store)
+        with profiler.span('zarr.open_group'):
+            self.root = zarr.open(self._store, path=self._path)
+        self.root.attrs['format_version'] = FORMAT_VERSION
         return self
 
     def __exit__(self, *args):
-        self._store.close()
+        if self._owns_store:
+            with profiler.span('zip.close'):
+                self._store.close()
         self.root = None
 
     def write_bin_array(
@@ -70,18 +175,41 @@ class BinArrayZarrWriter:
     ) -> zarr.Array:
         assert bin_array.dtype == np.uint8
 
-        if np.count_nonzero(bin_array) == 0:
-            empty = True
-            ds = group.create_dataset(name, data=np.array([], dtype=np.uint8))
-        else:
-            empty = False
-            ds = group.create_dataset(name, data=np.packbits(bin_array), compressor=self._compressor)
+        with profiler.span('write_bin_array'):
+            if np.count_nonzero(bin_array) == 0:
+                empty = True
+                ds = group.create_dataset(name, data=np.array([], dtype=np.uint8))
+            else:
+                empty = False
+                ds = group.create_dataset(name, data=np.packbits(bin_array), chunks=PACKED_CHUNK_SIZE,
+                                          compressor=self._compressor)
+
+        # zip store cannot overwrite entries, so all attributes are written at once
+        ds.attrs.put({
+            **(attrs if attrs is not None else {}),
+            'empty': empty,
+            'packed_shape': bin_array.shape
+        })
 
-        ds.attrs['empty'] = empty
-        ds.attrs['packed_shape'] = bin_array.shape
+        return ds
 
-        if attrs is not None:
-            for n, v in attrs.items():
-                ds.attrs[n] = v
 
-        return ds
+def iter_groups(group: zarr.Group, path: str = '') -> Iterator[Tuple[str, zarr.Group]]:
+    yield path, group
+    for name, child in group.groups():
+        yield from iter_groups(child, f'{path}{name}/')
+
+
+def copy_archive(reader: BinArrayZarrReader, writer: BinArrayZarrWriter):
+    buffers = {}
+    for path, group in iter_groups(reader.root):
+        attrs = {n: v for n, v in group.attrs.asdict().items() if n != 'format_version'}
+        dest_group = writer.root.require_group(path) if path else writer.root
+        if len(attrs) > 0:
+            dest_group.attrs.update(attrs)
+
+        for name, arr in group.arrays():
+            # arrays of the same shape reuse one decode buffer
+            bin_array, arr_attrs = reader.read_bin_array(name, group, buffers.get(tuple(arr.attrs['packed_shape'])))
+            buffers[bin_array.shape] = bin_array
+            writer.write_bin_array(name, bin_array, dest_group, arr_attrs)
@@ -0,0 +1,180 @@
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Type, Iterator
+
+import zarr
+from numcodecs.compat import ensure_bytes
+from zarr.storage import Store
+
+from utils import profiler
+from .bin_array_zarr_io import BinArrayZarrReader, BinArrayZarrWriter, FORMAT_VERSION, copy_archive
+from .segmentation_zarr_io import SegmentationZarrReader, SegmentationZarrWriter
+
+
+class BundleStore(Store):
+    """
+    Zarr store kept in a single SQLite table. Writes are grouped with ``transaction``, so a whole bundle member
+    is committed, and synced to disk, once. Directory operations select keys by exact prefix with range queries,
+    unlike LIKE patterns, which treat ``_`` as a wildcard and ignore case.
+    """
+
+    def __init__(self, file_path: Path):
+        self._db = sqlite3.connect(file_path.as_posix(), isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS zarr (k TEXT PRIMARY KEY, v BLOB)')
+
+    @staticmethod
+    def _key_range(path: str):
+        # keys under "path/" are exactly those in [path + "/", path + "0"), as "0" follows "/" in byte order
+        return (path + '/', path + '0') if path else ('', '\U0010ffff')
+
+    @contextmanager
+    def transaction(self):
+        if self._db.in_transaction:  # nested transactions are part of the outer one
+            yield
+            return
+
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        with profiler.span('bundle.commit'):
+            self._db.execute('COMMIT')
+
+    def __getitem__(self, key: str) -> bytes:
+        row = self._db.execute('SELECT v FROM zarr WHERE k = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key: str, value):
+        self._db.execute('INSERT OR REPLACE INTO zarr (k, v) VALUES (?, ?)', (key, ensure_bytes(value)))
+
+    def __delitem__(self, key: str):
+        if self._db.execute('DELETE FROM zarr WHERE k = ?', (key,)).rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return self._db.execute('SELECT 1 FROM zarr WHERE k = ?', (key,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([k for k, in self._db.execute('SELECT k FROM zarr ORDER BY k')])
+
+    def __len__(self) -> int:
+        return self._db.execute('SELECT COUNT(*) FROM zarr').fetchone()[0]
+
+    def listdir(self, path: str = '') -> List[str]:
+        start, stop = self._key_range(path)
+        keys = self._db.execute('SELECT k FROM zarr WHERE k >= ? AND k < ?', (start, stop))
+        return sorted({k[len(start):].split('/', 1)[0] for k, in keys})
+
+    def rmdir(self, path: str = ''):
+        with self.transaction():
+            self._db.execute('DELETE FROM zarr WHERE k >= ? AND k < ?', self._key_range(path))
+
+    def rename(self, src_path: str, dst_path: str):
+        with self.transaction():
+            self.rmdir(dst_path)
+            src_start, src_stop = self._key_range(src_path)
+            self._db.execute('UPDATE zarr SET k = ? || substr(k, ?) WHERE k >= ? AND k < ?',
+                             (dst_path + '/', len(src_start) + 1, src_start, src_stop))
+
+    def close(self):
+        self._db.close()
+
+
+class SegmentationBundle:
+    """
+    Single file container of segmentations of many volumes. Every volume is stored as a group laid out
+    the same way as a standalone .seg archive, so it is read and written with the same reader and writer
+    classes. A member is written into a temporary group and swapped in within one transaction, so it can be
+    read, replaced or removed without rewriting the others, and a failed write keeps the previous member.
+    Root attribute ``index`` maps volume names to their segment names.
+
+    The bundle relies on SQLite file locking, which is unreliable on some network file systems, so a bundle
+    should be written by one process at a time.
+    """
+
+    def __init__(self, bundle_path: Path):
+        self._bundle_path = bundle_path
+
+        with profiler.span('bundle.open'):
+            self._store = BundleStore(bundle_path)
+
+        self.root: zarr.Group = None
+
+    def __enter__(self):
+        with self._store.transaction():
+            self.root = zarr.open_group(self._store, mode='a', cache_attrs=False)
+            if 'format_version' not in self.root.attrs:
+                self.root.attrs.put({'format_version': FORMAT_VERSION, 'index': {}})
+            self.root.require_group('volumes')
+        return self
+
+    def __exit__(self, *args):
+        self._store.close()
+        self.root = None
+
+    @property
+    def index(self) -> Dict[str, List[str]]:
+        return self.root.attrs['index']
+
+    def get_volume_list(self) -> List[str]:
+        return sorted(self.index)
+
+    def reader(
+            self,
+            name: str,
+            reader_cls: Type[SegmentationZarrReader] = SegmentationZarrReader
+    ) -> SegmentationZarrReader:
+        if name not in self.index:
+            raise KeyError(f'Volume {name} not found in bundle {self._bundle_path}.')
+        return reader_cls(self._bundle_path, store=self._store, path=self._member_path(name))
+
+    @contextmanager
+    def writer(
+            self,
+            name: str,
+            writer_cls: Type[SegmentationZarrWriter] = SegmentationZarrWriter,
+            **kwargs
+    ) -> Iterator[SegmentationZarrWriter]:
+        """
+        Replaces segmentations of given volume, other members are left untouched.
+        """
+        member_path = self._member_path(name)
+        tmp_path = f'pending/{name}'
+
+        with self._store.transaction():
+            self._store.rmdir(tmp_path)
+            with writer_cls(self._bundle_path, store=self._store, path=tmp_path, **kwargs) as writer:
+                yield writer
+                segment_names = list(writer.root['segmentations'])
+
+            self._store.rename(tmp_path, member_path)
+            self._store.rmdir('pending')
+            self.root.attrs['index'] = {**self.index, name: segment_names}
+
+    def remove(self, name: str):
+        with self._store.transaction():
+            self._store.rmdir(self._member_path(name))
+
+            if name in self.index:
+                index = self.index
+                index.pop(name)
+                self.root.attrs['index'] = index
+
+    def extract(self, name: str, file_path: Path):
+        with self.reader(name, SegmentationZarrReader) as reader, BinArrayZarrWriter(file_path) as writer:
+            copy_archive(reader, writer)
+
+    def add_archive(self, name: str, file_path: Path):
+        with BinArrayZarrReader(file_path) as reader, self.writer(name) as writer:
+            copy_archive(reader, writer)
+
+    @staticmethod
+    def _member_path(name: str) -> str:
+        if '/' in name or name == '':
+            raise ValueError(f'Invalid volume name for bundle: "{name}".')
+        return f'volumes/{name}'
@@ -0,0 +1,296 @@
+"""
+Exports 2D training tiles of selected labels from .seg archives into fixed-size npz shards.
+
+Usage (from the SegmentEditorMultiLabel2D directory, e.g. with PythonSlicer):
+
+    python -m zarr_io.export /path/to/archives /path/to/dataset --labels liver kidney --tile-size 256 --workers 8
+
+Archives are streamed through a generator pipeline: slices containing selected labels are found with popcounts
+of packed data, only those slices are decoded, reading packed data in chunk-aligned blocks, and cut into tiles,
+and tiles are written into shards of ``--shard-size`` samples. Every worker writes its own shards, so memory is
+bounded by one shard per process. Each shard holds ``masks`` (N, labels, tile, tile) uint8, and ``cases``
+(archive paths relative to the root directory), ``slices`` and ``offsets`` of every sample, which locate the tile
+in the source volume. ``index.json`` lists the shards and ``failed_cases`` with errors of archives which could
+not be exported. Samples of a case written before its failure stay in the shards, so they should be dropped by
+``cases`` when the dataset is read.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Iterator, Dict, Tuple, Iterable
+
+import numpy as np
+import zarr
+
+from .analytics import popcount
+from .bin_array_zarr_io import chunk_aligned_block_size
+from .segmentation_zarr_io import SegmentationZarrReader
+
+
+class TileSample(NamedTuple):
+    case: str
+    slice_index: int
+    offset: Tuple[int, int]
+    # (labels, tile, tile) binary masks
+    masks: np.ndarray
+
+
+class PackedBlockReader:
+    """
+    Reads ascending byte ranges of packed array through chunk-aligned blocks, so every chunk is decompressed
+    at most once, also when ranges cross chunk boundaries.
+    """
+
+    def __init__(self, arr: zarr.Array):
+        self._arr = arr
+        self._block_size = chunk_aligned_block_size(arr)
+        self._start = 0
+        self._data = np.empty(0, dtype=np.uint8)
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        end = self._start + self._data.size
+        if start < self._start or start >= end:  # blocks read so far are not needed anymore
+            self._start = end = start // self._arr.chunks[0] * self._arr.chunks[0]
+            self._data = np.empty(0, dtype=np.uint8)
+
+        if end < stop:  # bytes before start are dropped, as ranges are ascending
+            consumed = min(start - self._start, self._data.size)
+            blocks = [self._data[consumed:]]
+            while end < stop:
+                blocks.append(self._arr[end:end + self._block_size])
+                end += blocks[-1].size
+            self._start += consumed
+            self._data = np.concatenate(blocks)
+
+        return self._data[start - self._start:stop - self._start]
+
+    def read_bits(self, start: int, stop: int) -> np.ndarray:
+        """
+        Unpacked bits of given ascending bit range, which does not need to start at byte boundary.
+        """
+        packed = self.read(start // 8, (stop + 7) // 8)
+        return np.unpackbits(packed)[start % 8:start % 8 + stop - start]
+
+
+def packed_slice_counts(arr: zarr.Array, shape: Tuple[int, ...]) -> np.ndarray:
+    """
+    Number of set voxels of every slice (along first axis) of packed binary array. Slices starting at byte
+    boundaries are counted with popcounts of packed bytes, others are unpacked one block at a time.
+    """
+    counts = np.zeros(shape[0], dtype=np.int64)
+    if arr.shape[0] == 0:
+        return counts
+
+    slice_bits = int(np.prod(shape[1:]))
+    slices_per_block = max(1, chunk_aligned_block_size(arr) * 8 // slice_bits)
+    block_reader = PackedBlockReader(arr)
+
+    for start in range(0, shape[0], slices_per_block):
+        stop = min(start + slices_per_block, shape[0])
+        if slice_bits % 8 == 0:
+            block = block_reader.read(start * slice_bits // 8, stop * slice_bits // 8)
+            counts[start:stop] = popcount(block.reshape(-1, slice_bits // 8))
+        else:
+            bits = block_reader.read_bits(start * slice_bits, stop * slice_bits)
+            counts[start:stop] = bits.reshape(-1, slice_bits).sum(axis=1, dtype=np.int64)
+    return counts
+
+
+class CaseSlices:
+    """
+    Decodes slices of selected segments of an opened archive.
+    """
+
+    def __init__(self, reader: SegmentationZarrReader, labels: List[str]):
+        group = reader.root['segmentations']
+        self._arrays = [reader.get_packed_array(n, group) if n in group else None for n in labels]
+
+        shapes = {tuple(arr.attrs['packed_shape']) for arr in self._arrays if arr is not None}
+        if len(shapes) > 1:
+            raise ValueError('Segments differ in shape.')
+        self.shape = shapes.pop() if shapes else None
+
+        self.slice_counts = np.zeros((len(labels), self.shape[0] if self.shape else 0), dtype=np.int64)
+        for i, arr in enumerate(self._arrays):
+            if arr is not None:
+                self.slice_counts[i] = packed_slice_counts(arr, self.shape)
+
+    def iter_slices(self, slice_indices: Iterable[int]) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Yields (labels, height, width) masks of given slices, which must be in ascending order.
+        """
+        slice_shape = self.shape[1:]
+        slice_bits = int(np.prod(slice_shape))
+        block_readers = [PackedBlockReader(arr) if arr is not None else None for arr in self._arrays]
+
+        for slice_index in slice_indices:
+            masks = np.zeros((len(self._arrays), *slice_shape), dtype=np.uint8)
+            for i, block_reader in enumerate(block_readers):
+                if self.slice_counts[i, slice_index] == 0:
+                    continue
+                bits = block_reader.read_bits(slice_index * slice_bits, (slice_index + 1) * slice_bits)
+                masks[i] = bits.reshape(slice_shape)
+            yield int(slice_index), masks
+
+
+def iter_tiles(
+        masks: np.ndarray,
+        tile_size: int,
+        stride: int,
+        min_voxels: int
+) -> Iterator[Tuple[Tuple[int, int], np.ndarray]]:
+    height, width = masks.shape[1:]
+    for y in range(0, max(height - tile_size, 0) + stride, stride):
+        for x in range(0, max(width - tile_size, 0) + stride, stride):
+            tile = masks[:, y:y + tile_size, x:x + tile_size]
+            if tile.sum(dtype=np.int64) < min_voxels:
+                continue
+            if tile.shape[1:] != (tile_size, tile_size):
+                tile = np.pad(tile, [(0, 0), (0, tile_size - tile.shape[1]), (0, tile_size - tile.shape[2])])
+            yield (y, x), tile
+
+
+def iter_case_samples(
+        file_path: Path,
+        case: str,
+        labels: List[str],
+        tile_size: int,
+        stride: int,
+        min_voxels: int
+) -> Iterator[TileSample]:
+    with SegmentationZarrReader(file_path) as reader:
+        case_slices = CaseSlices(reader, labels)
+        if case_slices.shape is None:
+            return
+
+        slice_indices = np.nonzero(case_slices.slice_counts.sum(axis=0) >= min_voxels)[0]
+        for slice_index, masks in case_slices.iter_slices(slice_indices):
+            for offset, tile in iter_tiles(masks, tile_size, stride, min_voxels):
+                yield TileSample(case, slice_index, offset, tile)
+
+
+class ShardWriter:
+
+    def __init__(self, output_dir: Path, prefix: str, shard_size: int, compress: bool = False):
+        self._output_dir = output_dir
+        self._prefix = prefix
+        self._shard_size = shard_size
+        self._compress = compress
+
+        self._samples: List[TileSample] = []
+        self.shards: List[Dict] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def add(self, sample: TileSample):
+        self._samples.append(sample)
+        if len(self._samples) == self._shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._samples) == 0:
+            return
+
+        file_name = f'{self._prefix}_{len(self.shards):05d}.npz'
+        save = np.savez_compressed if self._compress else np.savez
+        save(
+            self._output_dir / file_name,
+            masks=np.stack([s.masks for s in self._samples]),
+            cases=np.array([s.case for s in self._samples]),
+            slices=np.array([s.slice_index for s in self._samples], dtype=np.int32),
+            offsets=np.array([s.offset for s in self._samples], dtype=np.int32)
+        )
+
+        self.shards.append({'file': file_name, 'samples': len(self._samples)})
+        self._samples = []
+
+
+class ExportOptions(NamedTuple):
+    labels: List[str]
+    tile_size: int = 256
+    stride: int = 256
+    min_voxels: int = 1
+    shard_size: int = 1024
+    compress: bool = False
+
+
+def _export_worker(args: Tuple[int, Path, List[Path], Path, ExportOptions]) -> Tuple[List[Dict], List[Dict]]:
+    worker_idx, root_dir, archives, output_dir, options = args
+    failed_cases = []
+
+    with ShardWriter(output_dir, f'shard_{worker_idx:03d}', options.shard_size, options.compress) as shard_writer:
+        for file_path in archives:
+            case = file_path.relative_to(root_dir).as_posix()
+            try:
+                for sample in iter_case_samples(file_path, case, options.labels, options.tile_size, options.stride,
+                                                options.min_voxels):
+                    shard_writer.add(sample)
+            except Exception as e:
+                logging.error(f'{file_path}: {e!r}')
+                failed_cases.append({'case': case, 'error': repr(e)})
+
+    return shard_writer.shards, failed_cases
+
+
+def export_directory(
+        root_dir: Path,
+        output_dir: Path,
+        options: ExportOptions,
+        workers: int = None
+) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Returns written shards and cases which failed to export.
+    """
+    workers = workers or os.cpu_count()
+    archives = sorted(root_dir.rglob('*.seg'))
+    logging.info(f'Found {len(archives)} archives under {root_dir}.')
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    tasks = [(i, root_dir, archives[i::workers], output_dir, options) for i in range(workers)]
+
+    shards, failed_cases = [], []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for worker_shards, worker_failed_cases in executor.map(_export_worker, tasks):
+            shards.extend(worker_shards)
+            failed_cases.extend(worker_failed_cases)
+
+    with open(output_dir / 'index.json', 'w') as f:
+        json.dump({**options._asdict(), 'shards': shards, 'failed_cases': failed_cases}, f, indent=2)
+
+    return shards, failed_cases
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Export training tiles of .seg archives into npz shards.')
+    parser.add_argument('root_dir', type=Path, help='Directory searched recursively for .seg archives.')
+    parser.add_argument('output_dir', type=Path, help='Directory of written shards.')
+    parser.add_argument('--labels', nargs='+', required=True, help='Exported labels, in order of mask channels.')
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--stride', type=int, default=None, help='Tile stride, defaults to tile size.')
+    parser.add_argument('--min-voxels', type=int, default=1, help='Minimum labelled voxels of exported tile.')
+    parser.add_argument('--shard-size', type=int, default=1024, help='Number of samples per shard.')
+    parser.add_argument('--compress', action='store_true', help='Compress shards.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, defaults to CPU count.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    options = ExportOptions(args.labels, args.tile_size, args.stride or args.tile_size, args.min_voxels,
+                            args.shard_size, args.compress)
+    shards, failed_cases = export_directory(args.root_dir, args.output_dir, options, args.workers)
+
+    logging.info(f'{sum(s["samples"] for s in shards)} samples written to {len(shards)} shards, '
+                 f'{len(failed_cases)} cases failed.')
+    return 1 if failed_cases else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Rewrites .seg archives to the newest format version.
+
+Usage (from the SegmentEditorMultiLabel2D directory, e.g. with PythonSlicer):
+
+    python -m zarr_io.migrate /path/to/archives --workers 8
+
+Every archive is written to a temporary file next to the original, verified against the original, flushed to
+disk and then atomically moved over it. Archives already in the newest version are skipped, so an interrupted run
+can simply be started again. Temporary files are named after the run, so concurrent runs do not touch each
+other's files. Temporary files left by interrupted runs are removed with ``--clean-stale``, which must not be used
+while another run over the same directory is in progress.
+"""
+import argparse
+import logging
+import os
+import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from .bin_array_zarr_io import BinArrayZarrReader, BinArrayZarrWriter, FORMAT_VERSION, iter_groups, copy_archive
+
+TMP_SUFFIX = '.migrating'
+
+
+def verify_archive(src_path: Path, dest_path: Path):
+    with BinArrayZarrReader(src_path) as src, BinArrayZarrReader(dest_path) as dest:
+        if dest.format_version != FORMAT_VERSION:
+            raise ValueError(f'Migrated archive has format version {dest.format_version}.')
+
+        src_groups = list(iter_groups(src.root))
+        dest_groups = list(iter_groups(dest.root))
+        if [p for p, _ in src_groups] != [p for p, _ in dest_groups]:
+            raise ValueError('Migrated archive contains different groups.')
+
+        for (path, src_group), (_, dest_group) in zip(src_groups, dest_groups):
+            if list(src_group.array_keys()) != list(dest_group.array_keys()):
+                raise ValueError(f'Migrated archive contains different arrays in group "{path}".')
+
+            for name in src_group.array_keys():
+                src_array, src_attrs = src.read_bin_array(name, src_group)
+                dest_array, dest_attrs = dest.read_bin_array(name, dest_group)
+                if src_attrs != dest_attrs or not np.array_equal(src_array, dest_array):
+                    raise ValueError(f'Array {path}{name} differs after migration.')
+
+
+def fsync_path(path: Path):
+    if path.is_dir() and os.name == 'nt':  # directories cannot be opened on Windows
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def migrate_archive(file_path: Path, verify: bool = True, run_id: str = None) -> bool:
+    """
+    Returns False when the archive is already in the newest format version.
+    """
+    run_id = run_id or uuid.uuid4().hex
+    tmp_path = file_path.with_name(f'{file_path.name}.{run_id}{TMP_SUFFIX}')
+
+    try:
+        with BinArrayZarrReader(file_path) as reader:
+            if reader.format_version == FORMAT_VERSION:
+                return False
+
+            with BinArrayZarrWriter(tmp_path) as writer:
+                copy_archive(reader, writer)
+
+        if verify:
+            verify_archive(file_path, tmp_path)
+        fsync_path(tmp_path)
+        os.replace(tmp_path, file_path)
+        fsync_path(file_path.parent)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+    return True
+
+
+def _migrate_worker(args: Tuple[Path, bool, str]) -> Tuple[Path, str]:
+    file_path, verify, run_id = args
+    try:
+        return file_path, 'migrated' if migrate_archive(file_path, verify, run_id) else 'skipped'
+    except Exception as e:
+        return file_path, f'failed: {e!r}'
+
+
+def clean_stale_files(root_dir: Path):
+    """
+    Removes temporary files of interrupted runs. Must not be called while another run is in progress.
+    """
+    for tmp_path in root_dir.rglob(f'*.seg.*{TMP_SUFFIX}'):
+        logging.info(f'Removing stale temporary file {tmp_path}.')
+        tmp_path.unlink()
+
+
+def migrate_directory(root_dir: Path, workers: int = None, verify: bool = True) -> int:
+    """
+    Returns number of archives which failed to migrate.
+    """
+    run_id = uuid.uuid4().hex
+    archives = sorted(root_dir.rglob('*.seg'))
+    logging.info(f'Found {len(archives)} archives under {root_dir}.')
+
+    counts = {'migrated': 0, 'skipped': 0, 'failed': 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_migrate_worker, [(a, verify, run_id) for a in archives], chunksize=16)
+        for i, (file_path, status) in enumerate(results):
+            counts[status.split(':')[0]] += 1
+            if status.startswith('failed'):
+                logging.error(f'{file_path}: {status}')
+            if (i + 1) % 100 == 0 or i + 1 == len(archives):
+                logging.info(f'{i + 1}/{len(archives)} archives processed, {counts}.')
+
+    return counts['failed']
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=f'Migrate .seg archives to format version {FORMAT_VERSION}.')
+    parser.add_argument('root_dir', type=Path, help='Directory searched recursively for .seg archives.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, defaults to CPU count.')
+    parser.add_argument('--no-verify', action='store_true', help='Skip round trip verification.')
+    parser.add_argument('--clean-stale', action='store_true',
+                        help='Remove temporary files of interrupted runs first. Do not use while another run is active.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.clean_stale:
+        clean_stale_files(args.root_dir)
+
+    failed = migrate_directory(args.root_dir, args.workers, verify=not args.no_verify)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,42 +3,112 @@ from typing import Tuple, Dict, List
 
 import numpy as np
 import zarr
+from zarr.storage import BaseStore
 
 from .bin_array_zarr_io import BinArrayZarrReader, BinArrayZarrWriter
 
 
+def downsample_binary(bin_array: np.ndarray, factor: int = 2) -> np.ndarray:
+    """
+    Downsamples in-plane axes by ``factor``, output voxel is set when any voxel of its block is set. The first
+    (slice) axis is kept, so slices annotated separately are never merged.
+    """
+    pad = [(0, 0)] + [(0, -s % factor) for s in bin_array.shape[1:]]
+    if any(p for _, p in pad):
+        bin_array = np.pad(bin_array, pad)
+
+    blocks_shape = [bin_array.shape[0]] + [d for s in bin_array.shape[1:] for d in (s // factor, factor)]
+    return bin_array.reshape(blocks_shape).any(axis=tuple(range(2, len(blocks_shape), 2))).astype(np.uint8)
+
+
 class SegmentationZarrReader(BinArrayZarrReader):
 
-    def __init__(self, dest_path: Path):
-        super().__init__(dest_path)
+    def __init__(self, dest_path: Path, store: BaseStore = None, path: str = None):
+        super().__init__(dest_path, store, path)
 
         self._segment_group: zarr.Group = None
+        self._preview_group: zarr.Group = None
 
     def __enter__(self):
         super().__enter__()
         self._segment_group = self.root['segmentations']
+        self._preview_group = self.root.get('previews', None)
         return self
 
     def read_segmentation(
             self,
-            name: str
+            name: str,
+            out: np.ndarray = None
     ) -> Tuple[np.ndarray, Dict]:
-        return self.read_bin_array(name, self._segment_group)
+        return self.read_bin_array(name, self._segment_group, out)
 
     def get_segmentation_list(self) -> List[str]:
         return list(self._segment_group)
 
+    def get_preview_levels(self) -> List[int]:
+        if self._preview_group is None:
+            return []
+        return sorted(int(level) for level in self._preview_group)
+
+    def read_segmentation_preview(
+            self,
+            name: str,
+            level: int
+    ) -> Tuple[np.ndarray, Dict]:
+        return self.read_bin_array(name, self._get_preview_level_group(level))
+
+    def read_preview(
+            self,
+            level: int
+    ) -> Tuple[np.ndarray, List[str]]:
+        """
+        Combines previews of all segments into a label map, where value i + 1 stands for i-th returned
+        segment name. Overlapping segments are resolved in favour of the latter one.
+        """
+        names = self.get_segmentation_list()
+        level_group = self._get_preview_level_group(level)
+        label_map = None
+        mask_arr = None
+
+        for i, name in enumerate(names):
+            mask_arr, _ = self.read_bin_array(name, level_group, mask_arr)
+            if label_map is None:
+                label_map = np.zeros(mask_arr.shape, dtype=np.uint16)
+            label_map[mask_arr.view(bool)] = i + 1
+
+        return label_map, names
+
+    def _get_preview_level_group(self, level: int) -> zarr.Group:
+        if level not in self.get_preview_levels():
+            raise KeyError(f'Preview level {level} is not stored in {self._dest_path}, '
+                           f'available levels: {self.get_preview_levels()}.')
+        return self._preview_group[str(level)]
+
 
 class SegmentationZarrWriter(BinArrayZarrWriter):
 
-    def __init__(self, src_path: Path):
-        super().__init__(src_path)
+    def __init__(self, src_path: Path, preview_levels: int = 0, store: BaseStore = None, path: str = None):
+        """
+        With ``preview_levels`` > 0 every segmentation is also stored downsampled in-plane by 2 ** level for
+        each level, so overviews can be rendered without decoding full resolution masks.
+        """
+        super().__init__(src_path, store, path)
+
+        self._preview_levels = preview_levels
 
         self._segment_group: zarr.Group = None
+        self._preview_level_groups: List[zarr.Group] = []
 
     def __enter__(self):
         super().__enter__()
         self._segment_group = self.root.create_group('segmentations')
+
+        if self._preview_levels > 0:
+            preview_group = self.root.create_group('previews')
+            for level in range(1, self._preview_levels + 1):
+                level_group = preview_group.create_group(str(level))
+                level_group.attrs['downsample'] = 2 ** level
+                self._preview_level_groups.append(level_group)
         return self
 
     def write_segmentation(
@@ -46,4 +116,11 @@ class SegmentationZarrWriter(BinArrayZarrWriter):
             name: str,
             segmentation: np.ndarray
     ) -> zarr.Array:
-        return self.write_bin_array(name, segmentation, self._segment_group)
+        ds = self.write_bin_array(name, segmentation, self._segment_group)
+
+        preview = segmentation
+        for level_group in self._preview_level_groups:
+            preview = downsample_binary(preview)
+            self.write_bin_array(name, preview, level_group)
+
+        return ds
@@ -1,12 +1,12 @@
 from collections import OrderedDict
-from typing import List
+from typing import List, Dict, Tuple
 
 import numpy as np
 import slicer
 from MRMLCorePython import vtkMRMLSegmentationNode
 from vtkSegmentationCorePython import vtkSegmentation
 
-from utils import node_utils, generate_colors
+from utils import node_utils, generate_colors, profiler
 from zarr_io import SegmentationZarrReader, SegmentationZarrWriter
 
 
@@ -15,7 +15,8 @@ class SlicerSegmentZarrReader(SegmentationZarrReader):
     def read_to_segmentation_node(
             self,
             seg_node: vtkMRMLSegmentationNode,
-            segment_labels: List[str]
+            segment_labels: List[str],
+            shared_layers: bool = False
     ):
         colors = generate_colors(len(segment_labels), 0)
         label_colors = OrderedDict(list(zip(segment_labels, colors)))
@@ -24,6 +25,10 @@ class SlicerSegmentZarrReader(SegmentationZarrReader):
             if es not in label_colors:
                 label_colors[es] = generate_colors(1, i)[0]
 
+        if shared_layers:
+            self._read_to_shared_layers(seg_node, label_colors)
+            return
+
         for segment_name in sorted(self._segment_group):
             mask_arr, attrs = self.read_segmentation(segment_name)
 
@@ -34,6 +39,58 @@ class SlicerSegmentZarrReader(SegmentationZarrReader):
                 color=label_colors[segment_name]
             )
 
+    def _read_to_shared_layers(
+            self,
+            seg_node: vtkMRMLSegmentationNode,
+            label_colors: Dict[str, Tuple[float, ...]]
+    ):
+        """
+        Places segments greedily into the first labelmap layer they do not overlap with, so that memory
+        used by the segmentation scales with the number of layers instead of the number of segments.
+        """
+        layers: List[np.ndarray] = []
+        layer_sizes: List[int] = []
+        placements: Dict[str, Tuple[int, int]] = {}
+        mask_arr = None
+
+        for segment_name in sorted(self._segment_group):
+            # all segments share the volume shape, so one decode buffer is reused
+            mask_arr, attrs = self.read_segmentation(segment_name, mask_arr)
+            mask = mask_arr.view(bool)
+            if not mask.any():
+                continue
+
+            for layer_idx, layer in enumerate(layers):
+                if layer_sizes[layer_idx] < np.iinfo(np.uint8).max and not layer[mask].any():
+                    break
+            else:
+                layer_idx = len(layers)
+                layers.append(np.zeros(mask.shape, dtype=np.uint8))
+                layer_sizes.append(0)
+
+            layer_sizes[layer_idx] += 1
+            label_value = layer_sizes[layer_idx]
+            layers[layer_idx][mask] = label_value
+            placements[segment_name] = (layer_idx, label_value)
+
+        layer_images = []
+        while len(layers) > 0:
+            layer_images.append(node_utils.create_labelmap_layer(seg_node, layers.pop(0)))
+
+        for segment_name in sorted(self._segment_group):
+            if segment_name not in placements:
+                node_utils.create_new_segment(segment_name, seg_node, color=label_colors[segment_name])
+                continue
+
+            layer_idx, label_value = placements[segment_name]
+            node_utils.create_shared_labelmap_segment(
+                segment_name,
+                seg_node,
+                layer_images[layer_idx],
+                label_value,
+                color=label_colors[segment_name]
+            )
+
 
 class SlicerSegmentZarrWriter(SegmentationZarrWriter):
 
@@ -48,7 +105,8 @@ class SlicerSegmentZarrWriter(SegmentationZarrWriter):
         for segment in [seg.GetNthSegment(i) for i in range(seg.GetNumberOfSegments())]:
             segment_id = seg.GetSegmentIdBySegmentName(segment.GetName())
 
-            segment_mask: np.ndarray = slicer.util.arrayFromSegmentBinaryLabelmap(seg_node, segment_id)
+            with profiler.span('arrayFromSegmentBinaryLabelmap'):
+                segment_mask: np.ndarray = slicer.util.arrayFromSegmentBinaryLabelmap(seg_node, segment_id)
 
             self.write_segmentation(segment.GetName(), segment_mask.astype(np.uint8))
             written_segment_ids.append(segment_id)